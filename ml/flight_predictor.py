@@ -1,19 +1,31 @@
 """
 Flight Trajectory Prediction - Anti-Overfitting Focus
-Key insight: LSTM memorizes patterns -> need noise injection + simpler model
+Key insight: the recurrent encoder (GRU) memorizes patterns -> need noise injection + simpler model
 """
 import argparse
 import numpy as np
 import pandas as pd
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from numpy.lib.stride_tricks import sliding_window_view
 from torch.utils.data import Dataset, DataLoader
-from sklearn.preprocessing import StandardScaler
 from dataclasses import dataclass
 from pathlib import Path
 from tqdm import tqdm
 import pickle
 import math
+import gc
+import hashlib
+import copy
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from torch.compiler import disable as compiler_disable
+except ImportError:  # torch < 2.1 has no torch.compiler
+    def compiler_disable(fn):
+        return fn
 
 @dataclass
 class Config:
@@ -29,25 +41,110 @@ class Config:
     epochs: int = 200
     patience: int = 50
     min_seq_len: int = 40
+    cuda_graph: bool = True   # Replay the train step as a CUDA graph (CUDA only)
+    amp: bool = True          # bfloat16 autocast (CUDA only)
+    compile: bool = True      # torch.compile the model (CUDA only)
+    quantize_int8: bool = False  # Also checkpoint a dynamic int8 copy for CPU inference
+
+# Feature set
+# Heading enters only through vx/vy - sin/cos of it are recoverable from (vx, vy, velocity)
+FEATURE_COLS = ['lat', 'lon', 'vx', 'vy', 'vertrate']
+TARGET_COLS = ['d_lat', 'd_lon']  # Predict deltas instead of absolute
+
+ARTIFACTS_DIR = Path('ml/artifacts')
+CACHE_VERSION = 2  # Bump when the cached arrays or pickled scalers change format
+
+@dataclass
+class Scaler:
+    """Per-column standardization stats with StandardScaler's mean_/scale_ names"""
+    mean_: np.ndarray
+    scale_: np.ndarray
+
+def _standardize(values: np.ndarray):
+    """Standardize float64 columns into a new float32 array; returns (array, Scaler)"""
+    mean = values.mean(axis=0)
+    std = values.std(axis=0)
+    std[std == 0] = 1.0
+    # Arithmetic stays float64 (lat/lon need it); only the stored result is float32
+    out = np.empty(values.shape, dtype=np.float32)
+    np.subtract(values, mean, out=out, casting='same_kind')
+    np.divide(out, std, out=out, casting='same_kind')
+    return out, Scaler(mean, std)
 
 class FlightDataset(Dataset):
-    def __init__(self, X, y, base_pos, noise_std=0.0, training=True):
-        self.X = torch.FloatTensor(X)
-        self.y = torch.FloatTensor(y)
-        self.base_pos = torch.FloatTensor(base_pos)
-        self.noise_std = noise_std
-        self.training = training
+    """Samples packed row-wise as [X window | y horizon | base_pos] in one float32 matrix"""
+    def __init__(self, X, y, base_pos, training=True, pin_memory=False):
+        n = len(X)
+        self.x_shape, self.y_shape = X.shape[1:], y.shape[1:]
+        # One contiguous row per sample: a batch is a single gather and a single H2D copy.
+        # The packed array is the only copy - the tensor wraps it without copying again
+        self.flat = torch.from_numpy(np.concatenate(
+            [np.reshape(X, (n, -1)), np.reshape(y, (n, -1)), base_pos], axis=1, dtype=np.float32
+        ))
+        self.training = training  # Noise is injected per batch in Trainer.train_epoch
+        self.pin_memory = pin_memory
         
-    def __len__(self): return len(self.X)
+    def __len__(self): return len(self.flat)
     
     def __getitem__(self, i):
-        x = self.X[i]
-        if self.training and self.noise_std > 0:
-            x = x + torch.randn_like(x) * self.noise_std
-        return x, self.y[i], self.base_pos[i]
+        return self.flat[i]
+    
+    def __getitems__(self, idxs):
+        """Whole batch in one gather - replaces per-sample __getitem__ + collate"""
+        idxs = torch.as_tensor(idxs)
+        if not self.pin_memory:
+            return self.flat[idxs]
+        # Gather straight into pinned memory so the batch is ready for a non_blocking H2D copy
+        out = torch.empty((len(idxs), self.flat.shape[1]), pin_memory=True)
+        return torch.index_select(self.flat, 0, idxs, out=out)
+    
+    def unpack(self, batch):
+        """Split a packed (batch, row) tensor into X, y, base_pos views"""
+        nx, ny = math.prod(self.x_shape), math.prod(self.y_shape)
+        return (batch[:, :nx].view(-1, *self.x_shape),
+                batch[:, nx:nx + ny].view(-1, *self.y_shape),
+                batch[:, nx + ny:])
 
-def load_data(path: str, cfg: Config):
-    """Load with delta prediction target"""
+def _as_batch(batch):
+    """collate_fn for FlightDataset.__getitems__, which already returns a stacked batch"""
+    return batch
+
+def _cache_path(path: str, cfg: Config) -> Path:
+    """Cache directory keyed by the CSV's identity and everything that shapes the windows"""
+    stat = Path(path).stat()
+    key = (CACHE_VERSION, str(Path(path).resolve()), stat.st_mtime_ns, stat.st_size,
+           cfg.window, cfg.horizon, cfg.min_seq_len, FEATURE_COLS, TARGET_COLS)
+    return ARTIFACTS_DIR / f"cache_{hashlib.sha1(repr(key).encode()).hexdigest()[:12]}"
+
+def load_data(path: str, cfg: Config, use_cache: bool = True):
+    """Load with delta prediction target, reusing cached sequences when available"""
+    cache = _cache_path(path, cfg)
+    if use_cache and (cache / 'scalers.pkl').exists():
+        X_all, y_all, base_pos = (np.load(cache / f'{name}.npy', mmap_mode='r')
+                                  for name in ('X', 'y', 'base_pos'))
+        with open(cache / 'scalers.pkl', 'rb') as f:
+            scalers = pickle.load(f)
+        print(f"Loaded cached sequences from {cache}")
+    else:
+        X_all, y_all, base_pos, scalers = _build_sequences(path, cfg)
+        if use_cache:
+            cache.mkdir(parents=True, exist_ok=True)
+            for name, arr in (('X', X_all), ('y', y_all), ('base_pos', base_pos)):
+                np.save(cache / f'{name}.npy', arr)
+            # Written last - marks the cache as complete
+            with open(cache / 'scalers.pkl', 'wb') as f:
+                pickle.dump(scalers, f)
+    
+    split = int(0.8 * len(X_all))
+    print(f"Data: {len(X_all)} sequences | Train: {split} | Val: {len(X_all)-split}")
+    print(f"Features: {FEATURE_COLS} | Target: {TARGET_COLS}")
+    
+    return (X_all[:split], y_all[:split], base_pos[:split]), \
+           (X_all[split:], y_all[split:], base_pos[split:]), \
+           scalers
+
+def _build_sequences(path: str, cfg: Config):
+    """Feature engineering, scaling and shuffled sliding windows (float32)"""
     df = pd.read_csv(path)
     df = df.sort_values(['icao24', 'time']).reset_index(drop=True)
     
@@ -55,81 +152,94 @@ def load_data(path: str, cfg: Config):
     features = ['lat', 'lon', 'velocity', 'heading', 'vertrate']
     df[features] = df[features].ffill().bfill().fillna(0)
     
-    # Cyclical heading
+    # Velocity components from heading
     heading_rad = np.deg2rad(df['heading'].values)
-    df['sin_h'] = np.sin(heading_rad)
-    df['cos_h'] = np.cos(heading_rad)
-    
-    # Velocity components
-    df['vx'] = df['velocity'] * df['cos_h']
-    df['vy'] = df['velocity'] * df['sin_h']
+    df['vx'] = df['velocity'].values * np.cos(heading_rad)
+    df['vy'] = df['velocity'].values * np.sin(heading_rad)
     
-    # Compute deltas for targets
-    df['d_lat'] = df.groupby('icao24')['lat'].diff().fillna(0)
-    df['d_lon'] = df.groupby('icao24')['lon'].diff().fillna(0)
+    # Compute deltas for targets - frame is sorted by aircraft, so diff the whole
+    # column once and zero the first row of each aircraft
+    icao = df['icao24'].values
+    first_rows = np.empty(len(df), dtype=bool)
+    first_rows[:1] = True
+    np.not_equal(icao[1:], icao[:-1], out=first_rows[1:])
+    for col in ('lat', 'lon'):
+        vals = df[col].values
+        delta = np.diff(vals, prepend=vals[:1])
+        delta[first_rows] = 0
+        df[f'd_{col}'] = delta
     
-    # Feature set
-    feature_cols = ['lat', 'lon', 'vx', 'vy', 'vertrate', 'sin_h', 'cos_h']
-    target_cols = ['d_lat', 'd_lon']  # Predict deltas instead of absolute
+    feature_cols, target_cols = FEATURE_COLS, TARGET_COLS
     
-    # StandardScaler
-    scaler = StandardScaler()
-    target_scaler = StandardScaler()
-    
-    df[feature_cols] = scaler.fit_transform(df[feature_cols])
-    df[target_cols] = target_scaler.fit_transform(df[target_cols])
+    # Standardize to float32 arrays that the windows are cut from
+    feat, scaler = _standardize(df[feature_cols].to_numpy(dtype=np.float64))
+    target, target_scaler = _standardize(df[target_cols].to_numpy(dtype=np.float64))
     
     # Per-aircraft sequence generation
-    X_all, y_all, base_pos = [], [], []
+    # Aircraft are contiguous row runs - count windows per run to preallocate outputs
     total_win = cfg.window + cfg.horizon
     
-    for icao, grp in df.groupby('icao24'):
-        if len(grp) < cfg.min_seq_len:
-            continue
-        arr_feat = grp[feature_cols].values
-        arr_target = grp[target_cols].values
-        # Store raw lat/lon for reconstruction
-        arr_raw = grp[['lat', 'lon']].values
-        
-        for i in range(len(arr_feat) - total_win + 1):
-            X_all.append(arr_feat[i:i+cfg.window])
-            y_all.append(arr_target[i+cfg.window:i+total_win])
-            # Store last position of input window (normalized)
-            base_pos.append(arr_feat[i+cfg.window-1, :2])
+    starts = np.flatnonzero(first_rows)
+    ends = np.append(starts[1:], len(df))
+    keep = ends - starts >= max(cfg.min_seq_len, total_win)
+    starts, ends = starts[keep], ends[keep]
+    counts = ends - starts - total_win + 1
+    offsets = np.concatenate([[0], np.cumsum(counts)])
     
-    X_all = np.array(X_all)
-    y_all = np.array(y_all)
-    base_pos = np.array(base_pos)
+    n = int(offsets[-1])
+    X_all = np.empty((n, cfg.window, len(feature_cols)), dtype=np.float32)
+    y_all = np.empty((n, cfg.horizon, len(target_cols)), dtype=np.float32)
+    base_pos = np.empty((n, 2), dtype=np.float32)
     
-    # Shuffle before split
-    idx = np.random.permutation(len(X_all))
-    X_all, y_all, base_pos = X_all[idx], y_all[idx], base_pos[idx]
+    # Strided views built once over all rows: GX[r] = feat[r:r+window], GY[r] = target[r:r+horizon].
+    # A window never crosses aircraft because each run only reads its own n_win starts
+    if n:
+        GX = sliding_window_view(feat, (cfg.window, feat.shape[1])).squeeze(1)
+        GY = sliding_window_view(target, (cfg.horizon, target.shape[1])).squeeze(1)
     
-    split = int(0.8 * len(X_all))
-    print(f"Data: {len(X_all)} sequences | Train: {split} | Val: {len(X_all)-split}")
-    print(f"Features: {feature_cols} | Target: {target_cols}")
+    def fill(aircraft):
+        for start, off, n_win in zip(starts[aircraft].tolist(), offsets[aircraft].tolist(),
+                                     counts[aircraft].tolist()):
+            last = start + cfg.window - 1  # Last row of the input window
+            X_all[off:off+n_win] = GX[start:start+n_win]
+            y_all[off:off+n_win] = GY[last+1:last+1+n_win]
+            # Store last position of input window (normalized)
+            base_pos[off:off+n_win] = feat[last:last+n_win, :2]
     
-    return (X_all[:split], y_all[:split], base_pos[:split]), \
-           (X_all[split:], y_all[split:], base_pos[split:]), \
-           (scaler, target_scaler)
+    # One contiguous run of aircraft per worker; the slice copies release the GIL
+    workers = max(1, min(os.cpu_count() or 1, len(starts)))
+    chunks = np.array_split(np.arange(len(starts)), workers)
+    if workers == 1:
+        fill(chunks[0])
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(fill, chunks))
+    
+    # Shuffle before split (cached shuffled, so the split stays a contiguous slice)
+    idx = np.random.permutation(len(X_all))
+    return X_all[idx], y_all[idx], base_pos[idx], (scaler, target_scaler)
+
+@compiler_disable
+def _run_rnn(rnn, x):
+    """Recurrent pass kept out of torch.compile - compiled RNNs are slower than cuDNN"""
+    return rnn(x)
 
-class FlightLSTM(nn.Module):
-    """LSTM with temporal attention"""
+class FlightGRU(nn.Module):
+    """GRU with learned-query temporal attention"""
     def __init__(self, input_size: int, cfg: Config):
         super().__init__()
         self.cfg = cfg
         
-        self.lstm = nn.LSTM(
+        self.gru = nn.GRU(
             input_size, cfg.hidden, cfg.layers,
             batch_first=True, dropout=0
         )
         
         # Temporal attention - learn which timesteps matter most
-        self.attn = nn.Sequential(
-            nn.Linear(cfg.hidden, cfg.hidden // 2),
-            nn.Tanh(),
-            nn.Linear(cfg.hidden // 2, 1, bias=False)
-        )
+        # score_t = q · tanh(W h_t); q/k/v share the hidden width so SDPA can
+        # dispatch to its flash / mem-efficient kernels
+        self.key = nn.Linear(cfg.hidden, cfg.hidden)
+        self.query = nn.Parameter(torch.empty(1, 1, 1, cfg.hidden))
         
         self.dropout = nn.Dropout(cfg.dropout)
         self.fc = nn.Linear(cfg.hidden, cfg.horizon * 2)
@@ -137,60 +247,90 @@ class FlightLSTM(nn.Module):
         self._init_weights()
     
     def _init_weights(self):
-        for name, param in self.lstm.named_parameters():
+        for name, param in self.gru.named_parameters():
             if 'weight_ih' in name:
                 nn.init.xavier_uniform_(param)
             elif 'weight_hh' in name:
                 nn.init.orthogonal_(param)
             elif 'bias' in name:
                 nn.init.zeros_(param)
+        nn.init.normal_(self.query, std=self.cfg.hidden ** -0.5)
         nn.init.xavier_uniform_(self.fc.weight)
         nn.init.zeros_(self.fc.bias)
     
     def forward(self, x):
-        out, _ = self.lstm(x)  # (batch, seq, hidden)
+        out, _ = _run_rnn(self.gru, x)  # (batch, seq, hidden)
         
-        # Attention weights over time
-        attn_weights = self.attn(out).squeeze(-1)  # (batch, seq)
-        attn_weights = torch.softmax(attn_weights, dim=-1)
-        
-        # Weighted sum of LSTM outputs
-        context = torch.bmm(attn_weights.unsqueeze(1), out).squeeze(1)  # (batch, hidden)
+        # Softmax-weighted sum of GRU outputs over time, as one attention head:
+        # fused kernels need 4-D (batch, heads, seq, dim) inputs
+        q = self.query.expand(out.size(0), -1, -1, -1)  # (batch, 1, 1, hidden)
+        k = torch.tanh(self.key(out)).unsqueeze(1)       # (batch, 1, seq, hidden)
+        v = out.unsqueeze(1)                             # (batch, 1, seq, hidden)
+        context = F.scaled_dot_product_attention(q, k, v).view(-1, self.cfg.hidden)  # (batch, hidden)
         
         context = self.dropout(context)
         out = self.fc(context)
         return out.view(-1, self.cfg.horizon, 2)
 
 def haversine_km(lat1, lon1, lat2, lon2):
-    """Vectorized haversine distance in km"""
+    """Vectorized haversine distance in km between degree tensors (runs on their device)"""
     R = 6371.0
-    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
-    dlat, dlon = lat2 - lat1, lon2 - lon1
-    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
-    return 2 * R * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    half_rad = math.pi / 360.0  # degrees -> radians, halved
+    # a = sin²(dlat/2) + cos(lat1)·cos(lat2)·sin²(dlon/2), built in place
+    a = (lat2 - lat1).mul_(half_rad).sin_().square_()
+    sin2_dlon = (lon2 - lon1).mul_(half_rad).sin_().square_()
+    cos_prod = torch.deg2rad(lat1).cos_().mul_(torch.deg2rad(lat2).cos_())
+    a.addcmul_(cos_prod, sin2_dlon)
+    return a.clamp_(0, 1).sqrt_().asin_().mul_(2 * R)
 
 class Trainer:
     def __init__(self, model, train_data, val_data, scalers, cfg: Config):
         self.model = model
+        self.module = model  # Uncompiled handle for checkpointing
         self.cfg = cfg
         self.scaler, self.target_scaler = scalers
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.model.to(self.device)
+        # Graph replay needs at least one full batch (the partial one is dropped)
+        self.use_graph = (cfg.cuda_graph and self.device.type == 'cuda'
+                          and len(train_data[0]) >= cfg.batch)
+        self.use_amp = cfg.amp and self.device.type == 'cuda' and torch.cuda.is_bf16_supported()
+        self.graph = None
+        
+        # Fuse the attention/FC tail; Inductor's own CUDA graphs are skipped when
+        # the whole train step is already captured, since graphs cannot nest
+        if cfg.compile and self.device.type == 'cuda' and hasattr(torch, 'compile'):
+            mode = 'default' if self.use_graph else 'reduce-overhead'
+            self.model = torch.compile(self.model, mode=mode, fullgraph=False)
         
-        # Training with noise injection
+        # Training with noise injection (applied on-device in train_epoch)
+        # Graph replay needs a fixed batch shape, so the last partial batch is dropped
+        # Batches are gathered in-process (already pinned) - the data is in memory, so no workers
+        pin = self.device.type == 'cuda'
         self.train_loader = DataLoader(
-            FlightDataset(*train_data, noise_std=cfg.noise_std, training=True),
-            batch_size=cfg.batch, shuffle=True
+            FlightDataset(*train_data, training=True, pin_memory=pin),
+            batch_size=cfg.batch, shuffle=True, drop_last=self.use_graph,
+            collate_fn=_as_batch
         )
         # Validation without noise
         self.val_loader = DataLoader(
-            FlightDataset(*val_data, noise_std=0, training=False),
-            batch_size=cfg.batch
+            FlightDataset(*val_data, training=False, pin_memory=pin),
+            batch_size=cfg.batch, collate_fn=_as_batch
         )
         
-        # Optimizer with strong L2 regularization
+        # Device-side buffers and inverse-transform constants for validate (reused every epoch)
+        n_val = len(self.val_loader.dataset)
+        self.val_pred = torch.empty((n_val, cfg.horizon, 2), device=self.device)
+        self.val_true = torch.empty((n_val, cfg.horizon, 2), device=self.device)
+        self.val_base = torch.empty((n_val, 2), device=self.device)
+        as_t = lambda a: torch.as_tensor(a, dtype=torch.float64, device=self.device)
+        self.d_mean, self.d_std = as_t(self.target_scaler.mean_), as_t(self.target_scaler.scale_)
+        self.pos_mean, self.pos_std = as_t(self.scaler.mean_[:2]), as_t(self.scaler.scale_[:2])
+        
+        # Optimizer with strong L2 regularization; fused kernel updates all params at once on CUDA
         self.optimizer = torch.optim.AdamW(
-            model.parameters(), lr=cfg.lr, weight_decay=cfg.weight_decay
+            model.parameters(), lr=cfg.lr, weight_decay=cfg.weight_decay,
+            fused=self.device.type == 'cuda', capturable=self.use_graph
         )
         
         # Stable LR schedule - reduce on plateau
@@ -204,70 +344,109 @@ class Trainer:
     
     def train_epoch(self, epoch):
         self.model.train()
-        total_loss = 0
+        # Accumulate on device - a per-batch .item() would sync the GPU every step
+        total_loss = torch.zeros((), device=self.device)
         pbar = tqdm(self.train_loader, desc=f"Epoch {epoch}", leave=False)
+        unpack = self.train_loader.dataset.unpack
         
-        for X, y, _ in pbar:
-            X, y = X.to(self.device), y.to(self.device)
-            
-            self.optimizer.zero_grad()
-            pred = self.model(X)
-            loss = self.criterion(pred, y)
+        for step, batch in enumerate(pbar):
+            X, y, _ = unpack(batch.to(self.device, non_blocking=True))
+            loss = self._graph_step(X, y) if self.use_graph else self._train_step(X, y)
             
-            # Gradient clipping for stability
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_norm=1.0)
-            self.optimizer.step()
-            
-            total_loss += loss.item()
-            pbar.set_postfix({'loss': f'{loss.item():.6f}'})
+            total_loss += loss.detach()
+            if step % 50 == 0:
+                pbar.set_postfix({'loss': f'{loss.item():.6f}'})
         
-        return total_loss / len(self.train_loader)
+        return total_loss.item() / len(self.train_loader)
     
-    def validate(self):
-        self.model.eval()
-        all_pred, all_true, all_base = [], [], []
-        total_loss = 0
-        
-        with torch.no_grad():
-            for X, y, base in self.val_loader:
-                X, y = X.to(self.device), y.to(self.device)
-                pred = self.model(X)
-                total_loss += self.criterion(pred, y).item()
-                all_pred.append(pred.cpu().numpy())
-                all_true.append(y.cpu().numpy())
-                all_base.append(base.numpy())
-        
-        pred_delta = np.concatenate(all_pred)
-        true_delta = np.concatenate(all_true)
-        base = np.concatenate(all_base)
+    def _train_step(self, X, y):
+        """Single eager optimization step; also the body recorded into the CUDA graph"""
+        if self.cfg.noise_std:
+            X = X + torch.randn_like(X) * self.cfg.noise_std
         
-        # Inverse transform deltas
-        d_lat_mean, d_lat_std = self.target_scaler.mean_[0], self.target_scaler.scale_[0]
-        d_lon_mean, d_lon_std = self.target_scaler.mean_[1], self.target_scaler.scale_[1]
+        self.optimizer.zero_grad(set_to_none=True)
+        with self._autocast():
+            pred = self.model(X)
+            loss = self.criterion(pred, y)
         
-        pred_d_lat = pred_delta[:, :, 0] * d_lat_std + d_lat_mean
-        pred_d_lon = pred_delta[:, :, 1] * d_lon_std + d_lon_mean
-        true_d_lat = true_delta[:, :, 0] * d_lat_std + d_lat_mean
-        true_d_lon = true_delta[:, :, 1] * d_lon_std + d_lon_mean
+        # Gradient clipping for stability
+        loss.backward()
+        torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_norm=1.0)
+        self.optimizer.step()
+        return loss
+    
+    def _autocast(self):
+        """bfloat16 autocast; BF16 keeps FP32 range, so no GradScaler is needed"""
+        # Weight-cast cache must stay off for tensors reused across CUDA graph replays
+        return torch.autocast(self.device.type, dtype=torch.bfloat16,
+                              enabled=self.use_amp, cache_enabled=False)
+    
+    def _graph_step(self, X, y):
+        """Copy the batch into static buffers and replay the captured step"""
+        # The LR is baked into the captured optimizer kernels, so re-capture when the scheduler changes it
+        lr = self.optimizer.param_groups[0]['lr']
+        if self.graph is None or lr != self.graph_lr:
+            self._capture_graph(X, y)
+            self.graph_lr = lr
         
-        # Inverse transform base positions
-        lat_mean, lat_std = self.scaler.mean_[0], self.scaler.scale_[0]
-        lon_mean, lon_std = self.scaler.mean_[1], self.scaler.scale_[1]
+        self.static_X.copy_(X, non_blocking=True)
+        self.static_y.copy_(y, non_blocking=True)
+        self.graph.replay()
+        return self.static_loss
+    
+    def _capture_graph(self, X, y):
+        if self.graph is None:
+            self.static_X = X.clone()
+            self.static_y = y.clone()
+            # Warm up on a side stream so lazy init (cuDNN, optimizer state) happens outside the capture
+            s = torch.cuda.Stream()
+            s.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(s):
+                for _ in range(3):
+                    self._train_step(self.static_X, self.static_y)
+            torch.cuda.current_stream().wait_stream(s)
         
-        base_lat = base[:, 0:1] * lat_std + lat_mean
-        base_lon = base[:, 1:2] * lon_std + lon_mean
+        # Keep GC pauses out of the capture
+        gc.collect()
+        gc.freeze()
         
-        # Reconstruct absolute positions by cumulative sum of deltas
-        pred_lat = base_lat + np.cumsum(pred_d_lat, axis=1)
-        pred_lon = base_lon + np.cumsum(pred_d_lon, axis=1)
-        true_lat = base_lat + np.cumsum(true_d_lat, axis=1)
-        true_lon = base_lon + np.cumsum(true_d_lon, axis=1)
+        # Grads are allocated from the graph's private pool by the captured backward
+        self.optimizer.zero_grad(set_to_none=True)
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.static_loss = self._train_step(self.static_X, self.static_y)
+    
+    def validate(self):
+        self.model.eval()
+        # Everything stays on device; the only syncs are the two .item() calls at the end
+        total_loss = torch.zeros((), device=self.device)
+        start = 0
+        unpack = self.val_loader.dataset.unpack
         
-        distances = haversine_km(pred_lat, pred_lon, true_lat, true_lon)
-        mean_dist = distances.mean()
+        with torch.no_grad():
+            for batch in self.val_loader:
+                X, y, base = unpack(batch.to(self.device, non_blocking=True))
+                with self._autocast():
+                    pred = self.model(X)
+                    total_loss += self.criterion(pred, y)
+                end = start + len(X)
+                self.val_pred[start:end] = pred
+                self.val_true[start:end] = y
+                self.val_base[start:end] = base
+                start = end
+            
+            # Inverse transform (float64 - lat/lon need the precision) and reconstruct
+            # absolute positions by cumulative sum of deltas, all on device
+            base_latlon = (self.val_base.double() * self.pos_std + self.pos_mean)[:, None, :]
+            latlon = torch.stack([self.val_pred, self.val_true]).double()
+            latlon.mul_(self.d_std).add_(self.d_mean).cumsum_(dim=2).add_(base_latlon)
+            pred_latlon, true_latlon = latlon
+            
+            distances = haversine_km(pred_latlon[..., 0], pred_latlon[..., 1],
+                                     true_latlon[..., 0], true_latlon[..., 1])
+            mean_dist = distances.mean().item()
         
-        val_loss = total_loss / len(self.val_loader)
+        val_loss = total_loss.item() / len(self.val_loader)
         return val_loss, mean_dist
     
     def fit(self):
@@ -275,44 +454,75 @@ class Trainer:
         print(f"Config: window={self.cfg.window}, hidden={self.cfg.hidden}, dropout={self.cfg.dropout}")
         print(f"        noise_std={self.cfg.noise_std}, weight_decay={self.cfg.weight_decay}\n")
         
-        for epoch in range(1, self.cfg.epochs + 1):
-            train_loss = self.train_epoch(epoch)
-            val_loss, mean_dist = self.validate()
-            
-            lr = self.optimizer.param_groups[0]['lr']
-            print(f"Epoch {epoch:3d} | Train: {train_loss:.6f} | Val: {val_loss:.6f} | "
-                  f"Dist: {mean_dist:.2f}km | LR: {lr:.2e}")
-            
-            if mean_dist < self.best_dist:
-                self.best_dist = mean_dist
-                self.no_improve = 0
-                self.save_checkpoint()
-                print(f"         ✓ New best: {mean_dist:.2f}km")
-            else:
-                self.no_improve += 1
-            
-            # Step scheduler based on validation loss
-            self.scheduler.step(val_loss)
-            
-            if self.no_improve >= self.cfg.patience:
-                print(f"\nEarly stopping at epoch {epoch}")
-                break
+        # Move long-lived objects (data, model) out of GC tracking; automatic GC
+        # stays off inside each epoch and runs once at the epoch boundary
+        gc.collect()
+        gc.freeze()
+        
+        try:
+            for epoch in range(1, self.cfg.epochs + 1):
+                gc.disable()
+                try:
+                    train_loss = self.train_epoch(epoch)
+                finally:
+                    gc.enable()
+                gc.collect()
+                val_loss, mean_dist = self.validate()
+                
+                lr = self.optimizer.param_groups[0]['lr']
+                print(f"Epoch {epoch:3d} | Train: {train_loss:.6f} | Val: {val_loss:.6f} | "
+                      f"Dist: {mean_dist:.2f}km | LR: {lr:.2e}")
+                
+                if mean_dist < self.best_dist:
+                    self.best_dist = mean_dist
+                    self.no_improve = 0
+                    self.save_checkpoint()
+                    print(f"         ✓ New best: {mean_dist:.2f}km")
+                else:
+                    self.no_improve += 1
+                
+                # Step scheduler based on validation loss
+                self.scheduler.step(val_loss)
+                
+                if self.no_improve >= self.cfg.patience:
+                    print(f"\nEarly stopping at epoch {epoch}")
+                    break
+        finally:
+            gc.unfreeze()
         
         print(f"\n{'='*50}")
         print(f"Training complete! Best distance: {self.best_dist:.2f}km")
         return self.best_dist
     
     def save_checkpoint(self):
-        path = Path('ml/artifacts')
-        path.mkdir(parents=True, exist_ok=True)
-        torch.save({
-            'model': self.model.state_dict(),
+        ARTIFACTS_DIR.mkdir(parents=True, exist_ok=True)
+        ckpt = {
+            'model': self.module.state_dict(),
             'config': self.cfg,
             'scaler': self.scaler,
             'target_scaler': self.target_scaler
-        }, path / 'best_model.pt')
+        }
+        if self.cfg.quantize_int8:
+            ckpt['model_int8'] = self.quantized_model().state_dict()
+        torch.save(ckpt, ARTIFACTS_DIR / 'best_model.pt')
+    
+    def quantized_model(self):
+        """Dynamic int8 copy of the model (Linear + GRU weights) for CPU inference"""
+        cpu_model = copy.deepcopy(self.module).cpu().eval()
+        # Quantized GRU construction draws random init weights - keep the training RNG untouched
+        with torch.random.fork_rng(devices=[]):
+            return torch.ao.quantization.quantize_dynamic(
+                cpu_model, {nn.Linear, nn.GRU}, dtype=torch.qint8
+            )
 
 def main():
+    # Fixed input shapes: let cuDNN pick the fastest RNN kernels once, and allow
+    # TF32 tensor cores for whatever still runs in FP32 outside autocast
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision('high')
+    
     parser = argparse.ArgumentParser()
     parser.add_argument('--data', required=True, help='Path to CSV')
     parser.add_argument('--epochs', type=int, default=150)
@@ -320,18 +530,21 @@ def main():
     parser.add_argument('--window', type=int, default=30)
     parser.add_argument('--hidden', type=int, default=128)
     parser.add_argument('--dropout', type=float, default=0.4)
+    parser.add_argument('--quantize', action='store_true', help='Also save an int8 model for CPU inference')
+    parser.add_argument('--no-cache', action='store_true', help='Rebuild sequences instead of using the cache')
     args = parser.parse_args()
     
     cfg = Config(
         epochs=args.epochs, patience=args.patience, 
-        window=args.window, hidden=args.hidden, dropout=args.dropout
+        window=args.window, hidden=args.hidden, dropout=args.dropout,
+        quantize_int8=args.quantize
     )
     
     torch.manual_seed(42)
     np.random.seed(42)
     
-    train_data, val_data, scalers = load_data(args.data, cfg)
-    model = FlightLSTM(input_size=7, cfg=cfg)  # 7 features
+    train_data, val_data, scalers = load_data(args.data, cfg, use_cache=not args.no_cache)
+    model = FlightGRU(input_size=len(FEATURE_COLS), cfg=cfg)
     trainer = Trainer(model, train_data, val_data, scalers, cfg)
     trainer.fit()
 